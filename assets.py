@@ -0,0 +1,90 @@
+# assets.py
+# -*- coding: utf-8 -*-
+"""
+資源載入: 圖塊圖片 (平行解碼、縮放並打包成圖集)、字體快取與 NPC 對話框繪製。
+"""
+import functools
+import io
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+
+def load_image(tid):
+    """讀取並解碼圖塊 PNG，回傳 (tid, Surface)；於工作執行緒執行，尚未轉換成顯示格式"""
+    with open(os.path.join("images", f"{tid}.png"), "rb") as f:
+        return tid, pygame.image.load(io.BytesIO(f.read()), f"{tid}.png")
+
+
+def load_tiles(ids, tile):
+    """載入所有圖塊並縮放成 tile x tile，回傳 {tid: Surface}
+
+    圖檔讀取與 PNG 解碼交給執行緒池平行處理：每個工作執行緒只建立自己的
+    獨立 Surface，不與其他執行緒共用，也不碰顯示設定，因此在背景解碼是安全的。
+    需要顯示格式的 convert()/convert_alpha() 與縮放一律在主執行緒進行。
+    """
+    images = {}
+    with ThreadPoolExecutor() as ex:
+        decoded = dict(ex.map(load_image, ids))
+    for tid, img in decoded.items():
+        # 無透明通道的圖塊 (如地面) 用 convert()，避免逐像素 alpha 混合
+        img = img.convert_alpha() if img.get_flags() & pygame.SRCALPHA else img.convert()
+        images[tid] = pygame.transform.scale(img,(tile,tile))
+    return images
+
+
+def build_atlas(images, tile):
+    """將所有圖塊打包成一張圖集，回傳 (atlas, {tid: 圖集內 Rect})"""
+    atlas_cols = math.ceil(math.sqrt(len(images)))
+    atlas_rows = math.ceil(len(images)/atlas_cols)
+    atlas = pygame.Surface((atlas_cols*tile, atlas_rows*tile), pygame.SRCALPHA).convert_alpha()
+    atlas_rects = {}
+    for i,(tid,surf) in enumerate(images.items()):
+        r = pygame.Rect((i%atlas_cols)*tile, (i//atlas_cols)*tile, tile, tile)
+        atlas.blit(surf, r.topleft)
+        atlas_rects[tid] = r
+    return atlas, atlas_rects
+
+
+_FONT_CACHE = {}
+
+def get_font(path, name, size):
+    """依字型檔、系統字體或預設字體載入 Font，相同參數只載入一次"""
+    key = (path, name, size)
+    if key not in _FONT_CACHE:
+        if path and os.path.exists(path):
+            _FONT_CACHE[key] = pygame.font.Font(path, size)
+        elif name:
+            _FONT_CACHE[key] = pygame.font.SysFont(name, size)
+        else:
+            _FONT_CACHE[key] = pygame.font.Font(None, size)
+    return _FONT_CACHE[key]
+
+
+@functools.lru_cache(maxsize=64)
+def wrap_and_render(text, max_w, bubble_font):
+    """將 NPC 訊息自動換行並繪製成完整對話框 Surface (白底、黑框)"""
+    words = text.split(' ')
+    lines = []; line = ''
+    for word in words:
+        test = (line+' '+word).strip()
+        if bubble_font.size(test)[0] <= max_w:
+            line = test
+        else:
+            lines.append(line)
+            line = word
+    if line: lines.append(line)
+    padding = 4
+    lh = bubble_font.get_height()
+    bubble_w = max(bubble_font.size(l)[0] for l in lines) + padding*2
+    bubble_h = lh*len(lines) + padding*2
+    surf = pygame.Surface((bubble_w, bubble_h)).convert()
+    surf.fill((255,255,255))
+    pygame.draw.rect(surf, (0,0,0), surf.get_rect(), 1)
+    y0 = padding
+    for l in lines:
+        surf.blit(bubble_font.render(l, True, (0,0,0)), (padding, y0))
+        y0 += lh
+    return surf
@@ -0,0 +1,142 @@
+# llm.py
+# -*- coding: utf-8 -*-
+"""
+LLM 介面: 以 AsyncOpenAI 串流結構化輸出，將玩家輸入解析為移動 / 對話 / 錯誤指令。
+請求在背景執行緒的 asyncio 事件迴圈中執行，並以 LRU 快取重用相同輸入的回應。
+"""
+import asyncio
+import collections
+import concurrent.futures
+import copy
+import hashlib
+import os
+import shelve
+import threading
+import uuid
+
+import openai
+from pydantic import BaseModel
+from typing import List, Optional, Literal
+
+# 載入 Prompt
+with open("prompt.txt", "r", encoding="utf-8") as pf:
+    PROMPT_TEMPLATE = pf.read().strip()
+client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+MODEL = "gpt-4o"
+JSON_MODE_INSTRUCTION = "請僅回傳純 JSON 格式，勿額外說明或文字。"
+# 固定的系統訊息，每次呼叫只在後面接上使用者訊息；前綴逐位元組相同才能命中 OpenAI 提示快取
+# (PROMPT_TEMPLATE 已超過 1024 tokens 的快取門檻)，動態狀態一律放在最後的使用者訊息
+SYSTEM_MESSAGES = [
+    {"role":"system","content":PROMPT_TEMPLATE},
+    {"role":"system","content":JSON_MODE_INSTRUCTION},
+]
+# 本次執行固定的工作階段 id，以 user 參數送出，讓請求路由到同一份提示快取
+SESSION_ID = f"rpg-{uuid.uuid4().hex}"
+
+# 結構化解析回傳格式
+class MoveStep(BaseModel):
+    dir: Literal["up", "down", "left", "right"]
+    times: int
+
+class ApiResponse(BaseModel):
+    mode: Literal["move", "talk", "error"]
+    steps: Optional[List[MoveStep]] = None
+    content: Optional[str] = None
+
+# LLM 回應快取 (LRU)：相同位置、可否對話與相同輸入 (忽略大小寫與前後空白) 直接重用
+LLM_CACHE: "collections.OrderedDict[tuple, dict]" = collections.OrderedDict()
+LLM_CACHE_MAXSIZE = 512
+LLM_CACHE_MODES = ("move", "error")  # NPC 對話保持新鮮，不快取 talk
+LLM_CACHE_PERSIST_MODES = ("move",)  # 只保存移動結果，誤判的 error 重新啟動即失效
+LLM_CACHE_PATH = "llm_cache.db"      # 跨次執行保存快取的 shelve 檔，設為 None 則不保存
+# 快取版本：提示詞、模型或地圖 (岩漿 / NPC 配置) 改變時，已保存的快取整份作廢
+with open("map.json", "rb") as mf:
+    LLM_CACHE_VERSION = hashlib.sha256(
+        PROMPT_TEMPLATE.encode("utf-8") + b"\0" + MODEL.encode("utf-8") + b"\0" + mf.read()
+    ).hexdigest()
+
+
+def load_llm_cache():
+    """從 shelve 檔載入先前保存的快取，版本不符時略過"""
+    if LLM_CACHE_PATH:
+        with shelve.open(LLM_CACHE_PATH) as db:
+            if db.get("version") == LLM_CACHE_VERSION:
+                LLM_CACHE.update(db.get("entries", []))
+        while len(LLM_CACHE) > LLM_CACHE_MAXSIZE:
+            LLM_CACHE.popitem(last=False)
+
+
+def save_llm_cache():
+    """將快取中的移動結果連同版本寫回 shelve 檔"""
+    if LLM_CACHE_PATH:
+        with shelve.open(LLM_CACHE_PATH) as db:
+            db["version"] = LLM_CACHE_VERSION
+            db["entries"] = [(k, v) for k, v in LLM_CACHE.items()
+                             if v['mode'] in LLM_CACHE_PERSIST_MODES]
+
+
+async def call_openai(user_input, position, can_talk, on_step=None):
+    """非同步串流呼叫 OpenAI，並回傳結構化 ApiResponse dict
+
+    若提供 on_step，串流中每完成一個移動步驟就以該步驟 dict 呼叫一次，
+    呼叫端可據此提早開始移動。
+    """
+    key = (user_input.strip().casefold(), position['x'], position['y'], can_talk)
+    if key in LLM_CACHE:
+        LLM_CACHE.move_to_end(key)
+        return copy.deepcopy(LLM_CACHE[key])
+    messages = SYSTEM_MESSAGES + [
+        {"role":"user","content":(
+            f"{{\"x\":{position['x']},\"y\":{position['y']},"
+            f"\"can_talk\":{str(can_talk).lower()}}} {user_input}"
+        )}
+    ]
+    # 使用結構化輸出串流，部分解析結果中的移動步驟可先交給 on_step
+    sent = 0
+    async with client.beta.chat.completions.stream(
+        model=MODEL,
+        messages=messages,
+        response_format=ApiResponse,
+        user=SESSION_ID
+    ) as stream:
+        async for event in stream:
+            if on_step and event.type == "content.delta" and isinstance(event.parsed, dict):
+                if event.parsed.get('mode') == 'move':
+                    steps = event.parsed.get('steps') or []
+                    # 最後一個步驟可能仍在傳輸中，只送出後面已有新步驟的完整步驟
+                    while sent < len(steps) - 1:
+                        on_step(steps[sent]); sent += 1
+        completion = await stream.get_final_completion()
+    message = completion.choices[0].message
+    parsed: Optional[ApiResponse] = message.parsed
+    if parsed is None:
+        # 模型拒答時沒有結構化結果，以錯誤模式回傳且不寫入快取
+        return {"mode": "error", "steps": None, "content": message.refusal or ""}
+    # 印出結構化解析結果
+    print("API Parsed Response:", parsed.dict())
+    result = parsed.dict()
+    if result['mode'] in LLM_CACHE_MODES:
+        LLM_CACHE[key] = copy.deepcopy(result)
+        if len(LLM_CACHE) > LLM_CACHE_MAXSIZE:
+            LLM_CACHE.popitem(last=False)
+    return result
+
+
+def start_llm_loop():
+    """於背景執行緒啟動 asyncio 事件迴圈，LLM 請求在其中執行"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def stop_llm_loop(loop, pending_futures):
+    """取消未完成的請求並關閉連線後停止背景迴圈；關閉逾時則放棄等待，不阻擋結束流程"""
+    for fut in pending_futures:
+        fut.cancel()
+    closing = asyncio.run_coroutine_threadsafe(client.close(), loop)
+    try:
+        closing.result(timeout=5)
+    except concurrent.futures.TimeoutError:
+        closing.cancel()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
@@ -9,24 +9,21 @@
 當觸發 NPC 對話時，於 NPC 頭上方顯示對話框（縮小文字、自動換行、避免超出視窗）。
 """
 import pygame
+import asyncio
 import json
-import os
 import collections
-import re
 import openai
 import random  # 用於隨機生成玩家初始位置
 
-# 載入 Prompt
-with open("prompt.txt", "r", encoding="utf-8") as pf:
-    PROMPT_TEMPLATE = pf.read().strip()
-client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-MODEL = "gpt-4o"
+from assets import build_atlas, get_font, load_tiles, wrap_and_render
+from llm import call_openai, load_llm_cache, save_llm_cache, start_llm_loop, stop_llm_loop
 
 # 移動與動畫
 ENABLE_MOVEMENT = True
 MOVE_SPEED = 200       # 像素/秒
-ANIM_INTERVAL = 0.02   # 動畫切換間隔 (秒)
-IDLE_DELAY = 0.8       # 停止後延遲切回待機 (秒)
+FP_SHIFT = 8           # 角色座標以 1/256 像素為單位的定點整數
+ANIM_INTERVAL_MS = 20  # 動畫切換間隔 (毫秒)
+IDLE_DELAY_MS = 800    # 停止後延遲切回待機 (毫秒)
 LAVA_TILE = "200"
 IDLE_TILE = "300"
 ANIM_TILES = {
@@ -35,6 +32,7 @@ ANIM_TILES = {
     (-1, 0): ["330", "331"],
     (0, -1): ["340", "341"],
 }
+DIR_FROM_WORD = {"up": (0, 1), "down": (0, -1), "left": (-1, 0), "right": (1, 0)}
 
 # UI 參數
 INPUT_HEIGHT = 50
@@ -56,45 +54,49 @@ BUBBLE_FONT_SIZE = 16
 BUBBLE_FONT_PATH = FONT_PATH  # 或 None
 BUBBLE_FONT_NAME = FONT_NAME  # 或字體名稱，如 "Microsoft JhengHei"
 
-IGNORE_RE = re.compile(r"^\s*$")
 
-# 呼叫 LLM (結構化解析回傳)
-from pydantic import BaseModel
-from typing import List, Optional, Literal
+def step_towards(px, py, tpx, tpy, sx, sy, step):
+    """以定點整數朝目標前進 step 單位 (移動方向 sx, sy 為 -1/0/1)，回傳 (px, py, 是否抵達)"""
+    px += sx*step
+    if sx*(px - tpx) >= 0: px = tpx
+    py += sy*step
+    if sy*(py - tpy) >= 0: py = tpy
+    return px, py, px == tpx and py == tpy
 
-class MoveStep(BaseModel):
-    dir: Literal["up", "down", "left", "right"]
-    times: int
 
-class ApiResponse(BaseModel):
-    mode: Literal["move", "talk", "error"]
-    steps: Optional[List[MoveStep]] = None
-    content: Optional[str] = None
+def enqueue_step(step, move_queue):
+    """將單一移動步驟依 times 展開加入佇列，無法辨識的方向直接略過"""
+    delta = DIR_FROM_WORD.get(step.get('dir'))
+    if delta:
+        move_queue.extend((delta,) * step.get('times',1))
 
 
-def call_openai(user_input, position, can_talk):
-    """呼叫 OpenAI，並回傳結構化 ApiResponse dict"""
-    json_mode_instruction = "請僅回傳純 JSON 格式，勿額外說明或文字。"
-    messages = [
-        {"role":"system","content":PROMPT_TEMPLATE},
-        {"role":"system","content":json_mode_instruction},
-        {"role":"user","content":(
-            f"{{\"x\":{position['x']},\"y\":{position['y']},"
-            f"\"can_talk\":{str(can_talk).lower()}}} {user_input}"
-        )}
-    ]
-    # 使用 parse 進行結構化
-    completion = client.beta.chat.completions.parse(
-        model=MODEL,
-        messages=messages,
-        response_format=ApiResponse
-    )
-    parsed: ApiResponse = completion.choices[0].message.parsed
-    # 印出結構化解析結果
-    print("API Parsed Response:", parsed.dict())
-    return parsed.dict()
+def enqueue_llm_result(res, move_queue, latest_npc_msg, skip=0):
+    """套用 LLM 回應：移動步驟加入佇列，回傳 (error_msg, latest_npc_msg)
+
+    skip 為串流期間已加入佇列的步驟數，這些步驟不再重複加入。
+    """
+    if res.get('mode')=='move' and ENABLE_MOVEMENT:
+        for step in (res.get('steps') or [])[skip:]:  # steps 為 Optional，可能是 None
+            enqueue_step(step, move_queue)
+        return '', latest_npc_msg
+    elif res.get('mode')=='talk':
+        return '', res.get('content','')
+    else:
+        return res.get('content',''), latest_npc_msg
 
 
+def submit_input(input_text, pos, npc_positions, pending, loop):
+    """送出輸入：非空白時將 LLM 請求交給背景迴圈，回傳清空後的輸入文字 (Enter 與 Send 共用)"""
+    if input_text.strip():
+        can_talk = (pos['x'],pos['y']) in npc_positions
+        # 串流中完成的步驟由背景執行緒放入 req['steps']，主迴圈再取出套用
+        req = {'future': None, 'steps': collections.deque(), 'applied': 0}
+        on_step = req['steps'].append if ENABLE_MOVEMENT else None
+        coro = call_openai(input_text, dict(pos), can_talk, on_step)
+        req['future'] = asyncio.run_coroutine_threadsafe(coro, loop)
+        pending.append(req)
+    return ''
 
 
 def main():
@@ -102,13 +104,9 @@ def main():
     pygame.key.set_repeat(200,150)
     pygame.key.start_text_input()
 
-    # 字體載入
-    if FONT_PATH and os.path.exists(FONT_PATH):
-        font = pygame.font.Font(FONT_PATH, FONT_SIZE)
-    elif FONT_NAME:
-        font = pygame.font.SysFont(FONT_NAME, FONT_SIZE)
-    else:
-        font = pygame.font.Font(None, FONT_SIZE)
+    # 字體載入 (輸入框與對話框)
+    font = get_font(FONT_PATH, FONT_NAME, FONT_SIZE)
+    bubble_font = get_font(BUBBLE_FONT_PATH, BUBBLE_FONT_NAME, BUBBLE_FONT_SIZE)
 
     # 讀取地圖設定
     with open("map.json","r",encoding="utf-8") as f:
@@ -123,180 +121,248 @@ def main():
     w = 800
     tile = int(500 * (w/(16*500)))
     h = rows * tile + UI_HEIGHT
+    ui_top = h - UI_HEIGHT
     screen = pygame.display.set_mode((w,h))
     pygame.display.set_caption("遊戲 + 對話顯示介面")
 
-    # 載入圖像資源
-    images = {}
-    ids = set(sum(bg,[])) | {o['type'] for o in objects} | {IDLE_TILE}
-    for fr in ANIM_TILES.values(): ids |= set(fr)
-    for tid in ids:
-        img = pygame.image.load(os.path.join("images",f"{tid}.png")).convert_alpha()
-        images[tid] = pygame.transform.scale(img,(tile,tile))
-        # 解析 map.json 中 lava_block 為實際岩漿座標，阻擋玩家踏上
+    # 預先計算每格的繪製座標 (dests[ry][rx])，避免重複乘法與 tuple 配置
+    rows_m1 = rows - 1
+    dests = [[(rx*tile, (rows_m1-ry)*tile) for rx in range(cols)] for ry in range(rows)]
+    obj_dests = {(o['x'],o['y']): dests[o['y']][o['x']] for o in objects}
+
+    # 載入圖像資源，打包成圖集後繪製時以 area 取出對應圖塊
+    ids = {tid for row in bg for tid in row} | {o['type'] for o in objects} | {IDLE_TILE}
+    ids |= {tid for fr in ANIM_TILES.values() for tid in fr}
+    atlas, atlas_rects = build_atlas(load_tiles(ids, tile), tile)
+    # 解析 map.json 中 lava_block 為實際岩漿座標，阻擋玩家踏上
     lava_positions = {(c['x'], c['y']) for c in data.get('lava_block', [])}
-    # 保留 obj_set 作為繪製地面參考
-    obj_set = {(o['x'], o['y']) for o in objects}
-    obj_set = {(o['x'], o['y']) for o in objects}
-    # 保留 obj_set 作為繪製地面參考
-    obj_set = {(o['x'], o['y']) for o in objects}
+    # 可通行格表：外圍加一圈 0 作為邊界哨兵，岩漿格為 0，以 (y+1)*stride+(x+1) 索引
+    stride = cols + 2
+    passable = bytearray(stride * (rows+2))
+    for y in range(rows):
+        passable[(y+1)*stride+1:(y+1)*stride+1+cols] = b'\x01' * cols
+    for x, y in lava_positions:
+        passable[(y+1)*stride+x+1] = 0
+    # 物件所在格以地面繪製：floor_mask[ry*cols+rx] 為 1 表示該格是物件格
+    floor_mask = bytearray(cols*rows)
+    for o in objects:
+        floor_mask[o['y']*cols+o['x']] = 1
+
+    # 預先合成靜態地圖：物件所在格以地面繪製後再疊上物件，每幀只需一次 blit
+    orig_bg_surface = pygame.Surface((cols*tile, rows*tile)).convert()
+    orig_bg_surface.blits([(atlas, dests[ry][rx], atlas_rects['000' if floor_mask[ry*cols+rx] else tid])
+                           for ry,row in enumerate(bg) for rx,tid in enumerate(row)], doreturn=0)
+    for o in objects:
+        orig_bg_surface.blit(atlas, obj_dests[(o['x'],o['y'])], atlas_rects[o['type']])
+    bg_surface = orig_bg_surface.copy()
+    # 地圖、地圖右側空白 (地圖比視窗窄時) 與 UI 面板三塊區域組成整個視窗
+    map_rect = pygame.Rect(0, 0, cols*tile, rows*tile)
+    map_margin = pygame.Rect(cols*tile, 0, w-cols*tile, rows*tile)
+
+    def patch_floor(x, y):
+        """玩家所在格改以地面繪製 (物件格本身已是地面)"""
+        if not floor_mask[y*cols+x]:
+            bg_surface.blit(atlas, dests[y][x], atlas_rects['000'])
+
+    def restore_cell(x, y):
+        """玩家離開後，從原始合成圖還原該格"""
+        dest = dests[y][x]
+        bg_surface.blit(orig_bg_surface, dest, pygame.Rect(dest,(tile,tile)))
 
     # 玩家初始位置與狀態，隨機生成於 (0,0)~(4,6)，隨機生成於 (0,0)~(4,6)
     start_x = random.randint(0, 4)
     start_y = random.randint(0, 6)
     pos = {'x': start_x, 'y': start_y}
-    px = pos['x'] * tile
-    py = (rows-1-pos['y']) * tile
+    px, py = (v << FP_SHIFT for v in dests[pos['y']][pos['x']])
     move_queue = collections.deque()
     moving=False; last_dir=(0,0)
-    anim_t=0.0; anim_i=0; idle_t=IDLE_DELAY
+    # 動畫計時使用 pygame.time.get_ticks() 的整數毫秒，避免浮點累加誤差
+    next_anim_ms=0; anim_i=0; idle_since_ms=-IDLE_DELAY_MS
     target_px, target_py = px, py
+    patch_floor(pos['x'], pos['y'])
 
     # UI 元件
     input_text = ''
-    input_rect = pygame.Rect(INPUT_PADDING, h-UI_HEIGHT+INPUT_PADDING,
+    input_rect = pygame.Rect(INPUT_PADDING, ui_top+INPUT_PADDING,
                              w-3*INPUT_PADDING-BUTTON_WIDTH, BUTTON_HEIGHT)
     btn_rect = pygame.Rect(w-INPUT_PADDING-BUTTON_WIDTH,
-                           h-UI_HEIGHT+(INPUT_HEIGHT-BUTTON_HEIGHT)//2,
+                           ui_top+(INPUT_HEIGHT-BUTTON_HEIGHT)//2,
                            BUTTON_WIDTH, BUTTON_HEIGHT)
     error_msg = ''
     latest_npc_msg = ''
+    # 尚未完成的 LLM 請求，依送出順序套用結果，等待期間遊戲迴圈持續運作
+    load_llm_cache()
+    llm_loop = start_llm_loop()
+    pending = collections.deque()
+
+    # 靜態 UI 外框 (面板、輸入框、Send 按鈕、錯誤框與標籤) 預先畫成一張 Surface
+    send_surf = font.render('Send', True, BUTTON_TEXT_COLOR)
+    send_pos = (btn_rect.x+(BUTTON_WIDTH-send_surf.get_width())//2,
+                btn_rect.y+(BUTTON_HEIGHT-send_surf.get_height())//2)
+    er = pygame.Rect(INPUT_PADDING, h-ERROR_HEIGHT+5, w-2*INPUT_PADDING, ERROR_HEIGHT-10)
+    err_label = font.render("error: ", True, ERROR_TEXT_COLOR)
+    err_label_pos = (er.x+5, er.y+5)
+    err_msg_pos = (er.x+5+err_label.get_width(), er.y+5)
+    ui_chrome = pygame.Surface((w, UI_HEIGHT)).convert()
+    ui_chrome.fill((50,50,50))
+    pygame.draw.rect(ui_chrome, (255,255,255), input_rect.move(0, -ui_top))
+    pygame.draw.rect(ui_chrome, BUTTON_COLOR, btn_rect.move(0, -ui_top))
+    ui_chrome.blit(send_surf, (send_pos[0], send_pos[1]-ui_top))
+    pygame.draw.rect(ui_chrome, ERROR_BG, er.move(0, -ui_top))
+    ui_chrome.blit(err_label, (err_label_pos[0], err_label_pos[1]-ui_top))
+    # 輸入文字與錯誤訊息的渲染結果，僅在字串改變時重新渲染
+    last_input_text = None; input_surf = None
+    last_error_msg = None; error_surf = None
+    # 局部更新：每幀只把有變動的區域送到螢幕，首幀與視窗重繪時整頁更新
+    input_text_pos = (input_rect.x+5, input_rect.y+5)
+    # 輸入文字裁切在輸入框內，避免蓋到 Send 按鈕
+    input_clip = pygame.Rect(0, 0, input_rect.right-input_text_pos[0], input_rect.bottom-input_text_pos[1])
+    input_text_rect = pygame.Rect(input_text_pos, input_clip.size)
+    err_clip = pygame.Rect(0, 0, er.right-err_msg_pos[0], er.bottom-err_msg_pos[1])
+    ui_panel = pygame.Rect(0, ui_top, w, UI_HEIGHT)
+    input_area = pygame.Rect(0, ui_top, w, INPUT_HEIGHT)
+    error_area = pygame.Rect(0, h-ERROR_HEIGHT, w, ERROR_HEIGHT)
+    full_redraw = True
+    prev_player_rect = None; prev_curr = None
+    prev_bubble_rect = None; prev_bubble = None
+    max_bubble_w = min(w-2*INPUT_PADDING, tile*4)
+    # 滑鼠是否位於輸入框內，僅在 MOUSEMOTION 時更新
+    mouse_in_input = input_rect.collidepoint(pygame.mouse.get_pos())
 
     clock = pygame.time.Clock()
     running = True
     while running:
         dt = clock.tick(60)/1000.0
+        now_ms = pygame.time.get_ticks()
+        dirty = []
         for e in pygame.event.get():
             if e.type == pygame.QUIT:
                 running=False
-            elif e.type == pygame.TEXTINPUT and input_rect.collidepoint(pygame.mouse.get_pos()):
+            elif e.type == pygame.WINDOWEXPOSED:
+                full_redraw = True
+            elif e.type == pygame.MOUSEMOTION:
+                mouse_in_input = input_rect.collidepoint(e.pos)
+            elif e.type == pygame.TEXTINPUT and mouse_in_input:
                 input_text += e.text
             elif e.type == pygame.KEYDOWN:
                 if e.key == pygame.K_BACKSPACE:
                     input_text = input_text[:-1]
                 elif e.key == pygame.K_RETURN:
-                    if input_text.strip() and not IGNORE_RE.match(input_text):
-                        can_talk = (pos['x'],pos['y']) in npc_positions
-                        res = call_openai(input_text, pos, can_talk)
-                        if res.get('mode')=='move' and ENABLE_MOVEMENT:
-                            error_msg=''
-                            for step in res['steps']:
-                                dx,dy = {'up':(0,1),'down':(0,-1),'left':(-1,0),'right':(1,0)}[step['dir']]
-                                for _ in range(step.get('times',1)):
-                                    move_queue.append((dx,dy))
-                        elif res.get('mode')=='talk':
-                            error_msg=''
-                            latest_npc_msg = res.get('content','')
-                        else:
-                            error_msg = res.get('content','')
-                    input_text = ''
+                    input_text = submit_input(input_text, pos, npc_positions, pending, llm_loop)
             elif e.type == pygame.MOUSEBUTTONDOWN and e.button==1 and btn_rect.collidepoint(e.pos):
-                if input_text.strip() and not IGNORE_RE.match(input_text):
-                    can_talk = (pos['x'],pos['y']) in npc_positions
-                    res = call_openai(input_text, pos, can_talk)
-                    if res.get('mode')=='move' and ENABLE_MOVEMENT:
-                        error_msg=''
-                        for step in res['steps']:
-                            dx,dy = {'up':(0,1),'down':(0,-1),'left':(-1,0),'right':(1,0)}[step['dir']]
-                            for _ in range(step.get('times',1)):
-                                move_queue.append((dx,dy))
-                    elif res.get('mode')=='talk':
-                        error_msg=''
-                        latest_npc_msg = res.get('content','')
-                    else:
-                        error_msg = res.get('content','')
-                input_text = ''
+                input_text = submit_input(input_text, pos, npc_positions, pending, llm_loop)
+
+        # 套用 LLM 回應：最前面的請求串流中已完成的步驟先加入佇列，回應完成後再套用其餘結果
+        while pending:
+            req = pending[0]
+            while req['steps']:
+                enqueue_step(req['steps'].popleft(), move_queue); req['applied'] += 1
+            if not req['future'].done():
+                break
+            pending.popleft()
+            try:
+                res = req['future'].result()
+            except openai.OpenAIError as exc:
+                error_msg = str(exc)
+                continue
+            error_msg, latest_npc_msg = enqueue_llm_result(res, move_queue, latest_npc_msg, req['applied'])
 
         # 平滑移動
         if not moving and move_queue:
             dx,dy = move_queue.popleft()
             nx,ny = pos['x']+dx, pos['y']+dy
             # 邊界檢查與岩漿阻擋
-            if 0<=nx<cols and 0<=ny<rows and (nx,ny) not in lava_positions:
+            if passable[(ny+1)*stride+nx+1]:
+                restore_cell(pos['x'], pos['y'])
+                dirty.append(pygame.Rect(dests[pos['y']][pos['x']], (tile,tile)))
                 pos['x'],pos['y']=nx,ny
-                target_px = nx*tile; target_py=(rows-1-ny)*tile
-                moving=True; last_dir=(dx,dy); anim_t=0; anim_i=0; idle_t=0
-        if moving:
-            dxp = target_px - px; dyp = target_py - py; step = MOVE_SPEED*dt
-            px += step*(dxp/abs(dxp)) if abs(dxp)>step else dxp
-            py += step*(dyp/abs(dyp)) if abs(dyp)>step else dyp
-            if abs(px-target_px)<1e-3 and abs(py-target_py)<1e-3:
-                px,py = target_px,target_py; moving=False
+                patch_floor(nx, ny)
+                dirty.append(pygame.Rect(dests[ny][nx], (tile,tile)))
+                target_px, target_py = (v << FP_SHIFT for v in dests[ny][nx])
+                moving=True; last_dir=(dx,dy); next_anim_ms=now_ms+ANIM_INTERVAL_MS; anim_i=0
+        if moving and dt > 0:  # 視窗在背景時 clock.tick 可能回傳 0，略過本幀
+            # 畫面 y 軸向下，因此地圖上的 +y (往上) 對應畫面 -y
+            step = int(MOVE_SPEED * (1 << FP_SHIFT) * dt)
+            px, py, arrived = step_towards(px, py, target_px, target_py, last_dir[0], -last_dir[1], step)
+            if arrived:
+                moving=False
         # 動畫
         if moving:
-            anim_t += dt
-            if anim_t>=ANIM_INTERVAL:
-                anim_t -= ANIM_INTERVAL; anim_i = (anim_i+1)%len(ANIM_TILES[last_dir])
-            curr = ANIM_TILES[last_dir][anim_i]; idle_t=0
+            if now_ms>=next_anim_ms:
+                next_anim_ms += ANIM_INTERVAL_MS; anim_i = (anim_i+1)%len(ANIM_TILES[last_dir])
+            curr = ANIM_TILES[last_dir][anim_i]; idle_since_ms=now_ms
         else:
-            idle_t += dt
-            curr = IDLE_TILE if idle_t>=IDLE_DELAY else ANIM_TILES.get(last_dir,[IDLE_TILE])[anim_i]
-
-        # 繪製地圖與角色
-        screen.fill((0,0,0))
-        floor = obj_set|{(pos['x'],pos['y'])}
-        for ry,row in enumerate(bg):
-            for rx,tid in enumerate(row):
-                use = '000' if (rx,ry) in floor else tid
-                screen.blit(images[use], (rx*tile,(rows-1-ry)*tile))
-        for o in objects:
-            screen.blit(images[o['type']], (o['x']*tile,(rows-1-o['y'])*tile))
-        screen.blit(images[curr], (px,py))
-
-        # 繪製 NPC 對話框（自動換行、縮小文字、避免超出視窗）
+            curr = IDLE_TILE if now_ms-idle_since_ms>=IDLE_DELAY_MS else ANIM_TILES.get(last_dir,[IDLE_TILE])[anim_i]
+
+        # 決定本幀需重繪的區域：角色移動或換動畫格、對話框與文字變動；整頁重繪時為整個視窗
+        # 沒有任何變動時整幀略過繪製與螢幕更新
+        player_rect = pygame.Rect(px >> FP_SHIFT, py >> FP_SHIFT, tile, tile)
+        if player_rect != prev_player_rect or curr != prev_curr:
+            dirty.append(player_rect)
+            if prev_player_rect: dirty.append(prev_player_rect)
+            prev_player_rect = player_rect; prev_curr = curr
+
+        # NPC 對話框（自動換行、縮小文字、避免超出視窗）
+        bubble = bubble_rect = None
         if latest_npc_msg and npc_obj:
-            # 對話框字體載入
-            if BUBBLE_FONT_PATH and os.path.exists(BUBBLE_FONT_PATH):
-                bubble_font = pygame.font.Font(BUBBLE_FONT_PATH, BUBBLE_FONT_SIZE)
-            elif BUBBLE_FONT_NAME:
-                bubble_font = pygame.font.SysFont(BUBBLE_FONT_NAME, BUBBLE_FONT_SIZE)
-            else:
-                bubble_font = pygame.font.Font(None, BUBBLE_FONT_SIZE)
-            max_bubble_w = min(w-2*INPUT_PADDING, tile*4)
-            words = latest_npc_msg.split(' ')
-            lines = []; line = ''
-            for word in words:
-                test = (line+' '+word).strip()
-                if bubble_font.size(test)[0] <= max_bubble_w:
-                    line = test
-                else:
-                    lines.append(line)
-                    line = word
-            if line: lines.append(line)
-            padding = 4
-            lh = bubble_font.get_height()
-            bubble_w = max(bubble_font.size(l)[0] for l in lines) + padding*2
-            bubble_h = lh*len(lines) + padding*2
-            npc_px = npc_obj['x']*tile; npc_py=(rows-1-npc_obj['y'])*tile
+            bubble = wrap_and_render(latest_npc_msg, max_bubble_w, bubble_font)
+            bubble_w, bubble_h = bubble.get_size()
+            npc_px, npc_py = obj_dests[(npc_obj['x'],npc_obj['y'])]
             bx = npc_px + (tile-bubble_w)//2; by = npc_py - bubble_h - 8
             bx = max(INPUT_PADDING, min(bx, w-INPUT_PADDING-bubble_w))
             by = max(INPUT_PADDING, by)
-            br = pygame.Rect(bx, by, bubble_w, bubble_h)
-            pygame.draw.rect(screen, (255,255,255), br)
-            pygame.draw.rect(screen, (0,0,0), br, 1)
-            y0 = by + padding
-            for l in lines:
-                surf = bubble_font.render(l, True, (0,0,0))
-                screen.blit(surf, (bx+padding, y0))
-                y0 += lh
-
-        # 繪製 UI
-        pygame.draw.rect(screen, (50,50,50), (0, h-UI_HEIGHT, w, UI_HEIGHT))
-        pygame.draw.rect(screen, (255,255,255), input_rect)
-        screen.blit(font.render(input_text, True, (0,0,0)), (input_rect.x+5, input_rect.y+5))
-        pygame.draw.rect(screen, BUTTON_COLOR, btn_rect)
-        snd = font.render('Send', True, BUTTON_TEXT_COLOR)
-        screen.blit(snd, (btn_rect.x+(BUTTON_WIDTH-snd.get_width())//2,
-                           btn_rect.y+(BUTTON_HEIGHT-snd.get_height())//2))
-        er = pygame.Rect(INPUT_PADDING, h-ERROR_HEIGHT+5, w-2*INPUT_PADDING, ERROR_HEIGHT-10)
-        pygame.draw.rect(screen, ERROR_BG, er)
-        es = font.render(f"error: {error_msg}", True, ERROR_TEXT_COLOR)
-        screen.blit(es, (er.x+5, er.y+5))
-
-        pygame.display.flip()
-
-    pygame.quit()
-    pygame.key.stop_text_input()
+            bubble_rect = pygame.Rect(bx, by, bubble_w, bubble_h)
+        # 尺寸相同的新訊息也要重畫：wrap_and_render 有快取，同樣文字回傳同一個 Surface
+        if bubble_rect != prev_bubble_rect or bubble is not prev_bubble:
+            dirty += [r for r in (bubble_rect, prev_bubble_rect) if r]
+            prev_bubble_rect = bubble_rect; prev_bubble = bubble
+
+        if input_text != last_input_text:
+            input_surf = font.render(input_text, True, (0,0,0)); last_input_text = input_text
+            dirty.append(input_area)
+        shown_error = "…" if pending else error_msg  # 等待回應時顯示 …
+        if shown_error != last_error_msg:
+            error_surf = font.render(shown_error, True, ERROR_TEXT_COLOR); last_error_msg = shown_error
+            dirty.append(error_area)
+        if full_redraw:
+            dirty = [screen.get_rect()]
+        elif player_rect.collidelist(dirty) != -1:
+            dirty.append(player_rect)  # 角色帶有 alpha，底下只要有還原就整塊重畫
+        if not dirty:
+            continue
+
+        # 只重繪變動區域：背景與 UI 外框 → 角色 → 對話框，整批以 blits 送出，最後畫文字
+        blit_seq = []
+        for r in dirty:
+            c = r.clip(map_rect)
+            if c: blit_seq.append((bg_surface, c, c))
+            c = r.clip(ui_panel)
+            if c: blit_seq.append((ui_chrome, c, c.move(0, -ui_top)))
+            c = r.clip(map_margin)
+            if c: screen.fill((0,0,0), c)
+        if player_rect.collidelist(dirty) != -1:
+            blit_seq.append((atlas, player_rect, atlas_rects[curr]))
+        if bubble and bubble_rect.collidelist(dirty) != -1:
+            blit_seq.append((bubble, bubble_rect))
+        screen.blits(blit_seq, doreturn=0)
+        # 文字帶有 alpha，只在底下外框剛被還原時重畫，避免重複疊加
+        if input_text_rect.collidelist(dirty) != -1:
+            screen.blit(input_surf, input_text_pos, input_clip)
+        if er.collidelist(dirty) != -1:
+            screen.blit(error_surf, err_msg_pos, err_clip)
+
+        if full_redraw:
+            pygame.display.flip(); full_redraw = False
+        else:
+            pygame.display.update(dirty)
+
+    # 結束流程：即使關閉連線失敗，仍保存快取並關閉 pygame
+    try:
+        stop_llm_loop(llm_loop, [req['future'] for req in pending])
+    finally:
+        save_llm_cache()
+        pygame.quit()
+        pygame.key.stop_text_input()
 
 if __name__=='__main__':
     main()